@@ -1,15 +1,24 @@
 # standard library imports
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-from functools import reduce
-from json import loads
+from hashlib import blake2b
 
 # third party imports
+import numpy as np
 import pandas as pd
 import requests
-from fake_useragent import UserAgent
+from orjson import OPT_INDENT_2, dumps, loads
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # local imports
-from ..utils import BANDWIDTH_USE_DATA_PATH
+from ..utils import BANDWIDTH_USE_DATA_PATH, ETAGS_PATH, TIMESTAMP_FORMAT
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/141.0.0.0 Safari/537.36"
+)
 
 
 class IngestionPipeline:
@@ -23,7 +32,20 @@ class IngestionPipeline:
         Initialize the IngestionPipeline object
         """
 
-        self.ua = UserAgent()
+        # Share connections and the user agent across all requests in a run
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_maxsize=4,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+            ),
+        )
         self.regions_all = [
             "Central America",
             "Africa",
@@ -36,6 +58,93 @@ class IngestionPipeline:
             "North America",
         ]
 
+        # One bit per region so checking that all are present is a single
+        # integer comparison, with unknown regions setting a bit past the rest
+        self.region_bits = {region: 1 << i for i, region in enumerate(self.regions_all)}
+        self.region_unknown_bit = 1 << len(self.regions_all)
+        self.region_full_mask = self.region_unknown_bit - 1
+
+        # ETags of payloads that were already processed, keyed by candidate
+        self.etags = {}
+        if os.path.exists(ETAGS_PATH):
+            with open(ETAGS_PATH, "rb") as f:
+                self.etags = loads(f.read())
+
+    def __download_payload(self, url: str, v: str) -> tuple[bytes | None, str | None]:
+        """
+        Download the raw JSONP payload and its ETag for a single cache-busting
+        value, or None if it hasn't changed since it was last processed
+        """
+
+        headers = {}
+        if v in self.etags:
+            headers["If-None-Match"] = self.etags[v]
+
+        # Bound the connect and read waits so a stalled CDN edge can't hang the
+        # scheduled run
+        with self.session.get(
+            url, params={"v": v}, headers=headers, stream=True, timeout=(3.05, 10)
+        ) as response:
+            if response.status_code == 304:
+                return None, self.etags[v]
+
+            etag = response.headers.get("ETag")
+            return response.raw.read(decode_content=True), etag
+
+    def __series_list_to_df(self, series_list: list[dict]) -> pd.DataFrame | None:
+        """
+        Convert a list of Steam stats series into a dataframe with one column
+        per region, or None if not all regions are present
+        """
+
+        regions = []
+        timestamps_list = []
+        values_list = []
+        regions_mask = 0
+        for series in series_list:
+            region = series["label"]
+            # Each series is a list of [unix_ms, value] pairs, so convert it
+            # in one shot rather than element by element
+            arr = np.asarray(series["data"], dtype=np.int64).reshape(-1, 2)
+            regions.append(region)
+            timestamps_list.append(arr[:, 0])
+            values_list.append(arr[:, 1])
+            regions_mask |= self.region_bits.get(region, self.region_unknown_bit)
+
+        # Make sure that all regions are present
+        if regions_mask != self.region_full_mask:
+            return None
+
+        # Steam usually reports every region on the same strictly increasing
+        # grid, in which case the series line up as is. Otherwise align them
+        # on the sorted union of their timestamps in a single pass
+        timestamps = timestamps_list[0]
+        shared_grid = bool(np.all(timestamps[1:] > timestamps[:-1])) and all(
+            np.array_equal(timestamps, other) for other in timestamps_list[1:]
+        )
+        if not shared_grid:
+            timestamps = np.unique(np.concatenate(timestamps_list))
+
+        # Reinterpret the unix milliseconds as datetimes without converting
+        df_dict = {"Timestamp": timestamps.view("datetime64[ms]")}
+        for region, series_timestamps, series_values in zip(
+            regions, timestamps_list, values_list
+        ):
+            # Bandwidths are small integers in Gbps, so build the nullable
+            # Int32 column directly with a mask where a region has no sample
+            if shared_grid:
+                column_values = series_values.astype(np.int32)
+                column_mask = np.zeros(len(timestamps), dtype=bool)
+            else:
+                rows = np.searchsorted(timestamps, series_timestamps)
+                column_values = np.zeros(len(timestamps), dtype=np.int32)
+                column_mask = np.ones(len(timestamps), dtype=bool)
+                column_values[rows] = series_values
+                column_mask[rows] = False
+            df_dict[region] = pd.arrays.IntegerArray(column_values, column_mask)
+
+        return pd.DataFrame(df_dict)
+
     def __get_newest_bandwidth_data(self) -> pd.DataFrame | None:
         """
         Get newest download bandwidth usage data from Steam
@@ -43,14 +152,11 @@ class IngestionPipeline:
 
         # Steam CDN is kind of cursed so the following is a workaround to get the
         # most recent data if available
-        date_today_utc = datetime.now(timezone.utc).strftime("%m-%d-%Y")
-        hour_now_utc = datetime.now(timezone.utc).strftime("%H")
-        date_tomorrow_utc = (datetime.now(timezone.utc) + timedelta(days=1)).strftime(
-            "%m-%d-%Y"
-        )
-        date_month_ago_utc = (datetime.now(timezone.utc) - timedelta(days=30)).strftime(
-            "%m-%d-%Y"
-        )
+        now_utc = datetime.now(timezone.utc)
+        date_today_utc = now_utc.strftime("%m-%d-%Y")
+        hour_now_utc = now_utc.strftime("%H")
+        date_tomorrow_utc = (now_utc + timedelta(days=1)).strftime("%m-%d-%Y")
+        date_month_ago_utc = (now_utc - timedelta(days=30)).strftime("%m-%d-%Y")
         v1 = f"{date_today_utc}-{hour_now_utc}"
         v2 = date_today_utc
         v3 = date_tomorrow_utc
@@ -60,72 +166,107 @@ class IngestionPipeline:
         candidates = [v1, v2, v3, v4]
         newest_df = None
         most_recent_timestamp = None
-        for v in candidates:
-            headers = {"User-Agent": self.ua.random}
-            response = requests.get(url, params={"v": v}, headers=headers)
-            startidx = response.text.find("(")
-            endidx = response.text.find(")")
-            data = loads(response.text[startidx + 1 : endidx])
-            series_list = loads(data["json"])
-
-            df_list = []
-            regions_all_set = set(self.regions_all)
-            regions_seen = set()
-            for series in series_list:
-                df_dict = {}
-                region = series["label"]
-                df_dict["Timestamp"] = [
-                    pd.to_datetime(x[0], unit="ms") for x in series["data"]
-                ]
-                df_dict[region] = [int(x[1]) for x in series["data"]]
-                regions_seen.add(region)
-                df_list.append(pd.DataFrame(df_dict))
-
-            # Make sure that all regions are present
-            if regions_seen != regions_all_set:
+
+        # Data within about one sampling interval of now is as fresh as it gets
+        fresh_timestamp = (now_utc - timedelta(minutes=15)).replace(tzinfo=None)
+
+        # The candidates are independent, so fetch them concurrently and handle
+        # whichever arrives first
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = {
+            executor.submit(self.__download_payload, url, v): v for v in candidates
+        }
+        etags = {v: self.etags[v] for v in candidates if v in self.etags}
+        digests_seen = set()
+        for future in as_completed(futures):
+            body, etag = future.result()
+
+            # Unchanged payloads were already handled by a previous run
+            if body is None:
                 continue
+            if etag is not None:
+                etags[futures[future]] = etag
 
-            df = reduce(
-                lambda x, y: pd.merge(x, y, on="Timestamp", how="outer"), df_list
-            )
-            df = df.sort_values("Timestamp").reset_index(drop=True)
-            last_timestamp = df["Timestamp"].max()
+            # The CDN often ignores the cache-busting value and serves the same
+            # body, which can't produce anything newer than it already did
+            digest = blake2b(body, digest_size=16).digest()
+            if digest in digests_seen:
+                continue
+            digests_seen.add(digest)
+
+            # Parse the raw bytes in place instead of decoding the whole body
+            startidx = body.find(b"(")
+            endidx = body.rfind(b")")
+            data = loads(memoryview(body)[startidx + 1 : endidx])
+            df = self.__series_list_to_df(loads(data["json"]))
+            if df is None:
+                continue
+
+            last_timestamp = df["Timestamp"].iloc[-1]
 
             # Only keep the dataframe with the most recent timestamp
             if most_recent_timestamp is None or last_timestamp > most_recent_timestamp:
                 most_recent_timestamp = last_timestamp
                 newest_df = df
 
+            # No other candidate can be meaningfully newer, so skip the rest
+            if most_recent_timestamp >= fresh_timestamp:
+                break
+
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.etags = etags
+
         return newest_df
 
+    def __get_old_bandwidth_tail(self) -> tuple[list[str], pd.Timestamp]:
+        """
+        Get the column order and last timestamp of the bandwidth data on disk
+        without reading the whole file
+        """
+
+        with open(BANDWIDTH_USE_DATA_PATH, "rb") as f:
+            columns = f.readline().decode().strip().split(",")
+
+            # Rows are short, so the last one is always within the final block
+            f.seek(0, 2)
+            f.seek(max(f.tell() - 4096, 0))
+            last_row = f.read().decode().strip().splitlines()[-1].split(",")
+
+        return columns, pd.to_datetime(last_row[0], format=TIMESTAMP_FORMAT)
+
     def __merge_with_old(self, new_bandwidth_df: pd.DataFrame) -> None:
         """
-        Merge new data with old data and save to disk
+        Append data newer than the old data to disk
         """
 
-        # Update bandwidth data
-        old_bandwidth_df = pd.read_csv(
-            BANDWIDTH_USE_DATA_PATH, parse_dates=["Timestamp"]
-        )
-        end_timestamp_bandwidth_old = old_bandwidth_df["Timestamp"].max()
-        end_timestamp_bandwidth_new = new_bandwidth_df["Timestamp"].max()
+        # Update bandwidth data, where both the file and the new frame are
+        # sorted so their last rows hold the latest timestamps
+        columns, end_timestamp_bandwidth_old = self.__get_old_bandwidth_tail()
+        end_timestamp_bandwidth_new = new_bandwidth_df["Timestamp"].iloc[-1]
 
         if end_timestamp_bandwidth_new > end_timestamp_bandwidth_old:
-            new_bandwidth_df = new_bandwidth_df.loc[
-                new_bandwidth_df["Timestamp"] > end_timestamp_bandwidth_old
-            ]
-            updated_bandwidth_df = (
-                pd.concat(
-                    [old_bandwidth_df, new_bandwidth_df], axis=0, ignore_index=True
-                )
-                .sort_values("Timestamp")
-                .reset_index(drop=True)
+            # New data is sorted by timestamp, so binary search for the first
+            # row that isn't on disk yet instead of masking every row
+            start_idx = new_bandwidth_df["Timestamp"].searchsorted(
+                end_timestamp_bandwidth_old, side="right"
             )
-            updated_bandwidth_df[self.regions_all] = updated_bandwidth_df[
-                self.regions_all
-            ].astype("Int64")
+            new_bandwidth_df = new_bandwidth_df.iloc[start_idx:][columns]
 
-            updated_bandwidth_df.to_csv(BANDWIDTH_USE_DATA_PATH, index=False)
+            new_bandwidth_df.to_csv(
+                BANDWIDTH_USE_DATA_PATH,
+                mode="a",
+                header=False,
+                index=False,
+                date_format=TIMESTAMP_FORMAT,
+            )
+
+    def __save_etags(self) -> None:
+        """
+        Save the ETags of processed payloads to disk for the next run
+        """
+
+        with open(ETAGS_PATH, "wb") as f:
+            f.write(dumps(self.etags, option=OPT_INDENT_2))
 
     def run(self) -> None:
         """
@@ -138,3 +279,5 @@ class IngestionPipeline:
             self.__merge_with_old(bandwidth_df)
         else:
             print("No new complete bandwidth data available")
+
+        self.__save_etags()
@@ -8,3 +8,5 @@ import os
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 BANDWIDTH_USE_DATA_PATH = os.path.join(DATA_DIR, "bandwidths.csv")
+ETAGS_PATH = os.path.join(DATA_DIR, "etags.json")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"